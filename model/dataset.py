@@ -3,9 +3,256 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 """ dataset.py """
-import glob
+import hashlib
 import os
-from model.utils.dataloader_keras import genUnbalSequence
+import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from model.utils.audio_utils import AudioCache, WavBlob
+from model.utils.dataloader_keras import genUnbalSequence, PrefetchSequence
+
+
+def _as_path_array(fps):
+    """
+    Sorted, read-only numpy array (dtype=object) of file paths.
+
+    Object arrays hold the same str objects as a list, but can be sliced and
+    fancy-indexed like any array, and being read-only they can be shared
+    safely between Dataset instances and sequences.
+
+    """
+    fps = np.sort(np.asarray(fps, dtype=object), kind='stable')
+    fps.flags.writeable = False
+    return fps
+
+
+# File names indexed as audio. Case-sensitive, as load_audio() only decodes
+# names ending with 'wav'.
+_WAV_RE = re.compile(r'\.wav\Z')
+
+
+def _is_wav(fn):
+    return _WAV_RE.search(fn) is not None and not fn.startswith('.')
+
+
+def _stat_subdirs(dirpath, dirnames, dir_mtimes):
+    """ Store the mtimes of the subdirectories, before they are listed. """
+    if dir_mtimes is None:
+        return
+    for d in dirnames:
+        try:
+            dir_mtimes[os.path.join(dirpath, d)] = os.stat(
+                os.path.join(dirpath, d)).st_mtime_ns
+        except OSError:
+            pass
+
+
+def _index_wavs(top, dir_mtimes=None):
+    """
+    Unsorted list of '.wav' file paths under the directory top (recursive).
+
+    Same files as glob.glob(top + '**/*.wav', recursive=True), but
+    walks the tree once with os.walk and matches the file names against
+    _WAV_RE. Hidden entries are skipped as glob does. If dir_mtimes is a
+    dict, the mtimes of the walked subdirectories of top are stored in it.
+
+    """
+    fps = []
+    for dirpath, dirnames, filenames in os.walk(top, followlinks=True):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        _stat_subdirs(dirpath, dirnames, dir_mtimes)
+        fps.extend(
+            os.path.join(dirpath, fn) for fn in filenames if _is_wav(fn))
+    return fps
+
+
+def _index_wav_splits(root, splits, dir_mtimes=None):
+    """
+    Unsorted lists of '.wav' file paths for several top-level splits of root.
+
+    Returns {split: fps}, e.g. {'tr/': [...], 'ts/': [...]}. Instead of one
+    walk per split, root is walked once: os.walk only descends into the
+    requested split directories, and each file is assigned to a split by the
+    first component of its path relative to root. dir_mtimes: see
+    _index_wavs().
+
+    """
+    names = {split.rstrip(os.sep): split for split in splits}
+    fps = {split: [] for split in splits}
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        rel = dirpath[len(root):].lstrip(os.sep)
+        if not rel:
+            dirnames[:] = [d for d in dirnames if d in names]
+            continue
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        _stat_subdirs(dirpath, dirnames, dir_mtimes)
+        fps[names[rel.split(os.sep, 1)[0]]].extend(
+            os.path.join(dirpath, fn) for fn in filenames if _is_wav(fn))
+    return fps
+
+
+# Index of '.wav' file paths shared by all Dataset instances:
+# {(root, split): fps}, with fps as returned by _as_path_array().
+_INDEX_CACHE = dict()
+
+
+# Manifest of an indexed directory, stored inside it. Hidden: never indexed.
+_MANIFEST_NAME = '.wav.lst'
+
+
+def _read_manifest(top):
+    """
+    File paths from the manifest of top, or None if missing or stale.
+
+    The manifest is stale if top is more recent than it, or if any indexed
+    subdirectory has another mtime than when it was indexed (adding,
+    removing or renaming a file updates the mtime of its directory). This
+    costs one stat() per directory, none per file.
+
+    """
+    manifest = os.path.join(top, _MANIFEST_NAME)
+    try:
+        if os.path.getmtime(manifest) < os.path.getmtime(top):
+            return None
+        with open(manifest, 'r') as fin:
+            lines = fin.read().splitlines()
+        # Format: n_dirs, n_dirs lines of '<mtime_ns> <dir>', then the files.
+        n_dirs = int(lines[0])
+        for line in lines[1:n_dirs + 1]:
+            mtime_ns, rel_dir = line.split(' ', 1)
+            if os.stat(os.path.join(top, rel_dir)).st_mtime_ns != int(
+                    mtime_ns):
+                return None
+        # Stored relative to top: join with top as spelled now.
+        return [os.path.join(top, fp) for fp in lines[n_dirs + 1:]]
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _write_manifest(top, fps, dir_mtimes):
+    """
+    Store fps as the manifest of top, if top exists and is writable.
+
+    dir_mtimes: {dirpath: mtime_ns} of the indexed subdirectories, as
+    collected by _index_wavs(); entries outside top are ignored.
+
+    """
+    if not os.path.isdir(top):
+        return
+    manifest = os.path.join(top, _MANIFEST_NAME)
+    # Paths relative to top, so that the manifest stays valid with another
+    # working directory or an absolute/relative spelling of the same root.
+    prefix = os.path.join(top, '')
+
+    def rel(fp):
+        if fp.startswith(prefix):
+            return fp[len(prefix):]
+        return os.path.relpath(fp, top)
+
+    dirs = ['{} {}'.format(mtime_ns, rel(d))
+            for d, mtime_ns in dir_mtimes.items() if d.startswith(prefix)]
+    # Write-then-rename, so that readers never see a partial manifest.
+    tmp = f'{manifest}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as fout:
+            fout.write(f'{len(dirs)}\n')
+            fout.writelines(d + '\n' for d in dirs)
+            fout.writelines(rel(fp) + '\n' for fp in fps)
+        os.replace(tmp, manifest)
+        # Adding the manifest updated the mtime of top: the manifest must
+        # not look older than it.
+        os.utime(manifest)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _load_or_build_indices(root, splits):
+    """
+    Sorted arrays of '.wav' file paths under root + split, for each split.
+
+    Returns {split: fps}, see _as_path_array(). Each list is stored in
+    '<root>/<split>/.wav.lst' inside the indexed directory, with paths
+    relative to it, so that the same manifest serves relative and absolute
+    roots from any working directory. The manifest is reused as long as no
+    directory of the indexed tree was modified since, see _read_manifest().
+    If the manifest cannot be written (e.g. read-only dataset), the index
+    is just not persisted. Results are also kept in _INDEX_CACHE for the
+    lifetime of the process.
+
+    Several splits must be top-level directories of root (e.g. 'tr/' and
+    'ts/'): the missing ones are then indexed with a single walk of root.
+
+    """
+    out = dict()
+    stale = []
+    for split in splits:
+        if (root, split) not in _INDEX_CACHE:
+            fps = _read_manifest(root + split)
+            if fps is None:
+                stale.append(split)
+                continue
+            _INDEX_CACHE[(root, split)] = _as_path_array(fps)
+        out[split] = _INDEX_CACHE[(root, split)]
+
+    dir_mtimes = dict()
+    if len(stale) == 1:
+        built = {stale[0]: _index_wavs(root + stale[0], dir_mtimes)}
+    elif stale:
+        built = _index_wav_splits(root, stale, dir_mtimes)
+    else:
+        built = dict()
+    for split, fps in built.items():
+        fps = _as_path_array(fps)
+        _write_manifest(root + split, fps, dir_mtimes)
+        out[split] = _INDEX_CACHE[(root, split)] = fps
+    return out
+
+
+def _load_or_build_index(root, split=''):
+    """ Sorted array of '.wav' file paths under root + split, see above. """
+    return _load_or_build_indices(root, [split])[split]
+
+
+def _build_wav_blob(fps, path, fs, quantize=True):
+    """
+    WavBlob.build(fps, path, fs, quantize), or None with a warning on failure.
+
+    A failure is recorded in path + '.err' with the build arguments, so that
+    other processes do not decode the files again just to fail on the same
+    one. The build is retried once the file list changes, or after deleting
+    the '.err' file (e.g. once the offending file was fixed in place).
+
+    """
+    key = '{} {} {}'.format(
+        fs, int(quantize),
+        hashlib.sha1('\n'.join(fps).encode('utf-8')).hexdigest())
+    err_path = path + '.err'
+    try:
+        with open(err_path, 'r') as fin:
+            err_key, err = fin.read().split('\n', 1)
+        if err_key == key:
+            warnings.warn(f'Not building {path}, which failed before: '
+                          f'{err.strip()} (delete {err_path} to retry)')
+            return None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        blob = WavBlob.build(fps, path, fs, quantize)
+    except (OSError, ValueError) as e:
+        warnings.warn(f'Cannot build {path}: {e}')
+        try:
+            with open(err_path, 'w') as fout:
+                fout.write(f'{key}\n{e}\n')
+        except OSError:
+            pass
+        return None
+
+    if os.path.exists(err_path):
+        os.remove(err_path)
+    return blob
 
 
 class Dataset:
@@ -33,6 +280,33 @@ class Dataset:
     get_custom_db_ds(source, dir)
 
     """
+    # Every attribute set in __init__(): assigning any other name (e.g. a
+    # misspelled one) raises AttributeError. The augmentation file lists
+    # (tr_bg_fps, ...) are properties, see _AUG_FPS_SPECS.
+    __slots__ = (
+        # Data location
+        'source_root_dir', 'mix_root_dir', 'bg_root_dir', 'ir_root_dir',
+        'speech_root_dir', '_val_source_dir', '_ts_dummy_db_source_dir',
+        '_ts_query_icassp_dir', '_ts_db_icassp_dir', '_ts_query_db_unseen_dir',
+        # Data selection
+        'datasel_train', 'datasel_test_dummy_db', 'datasel_test_query_db',
+        # BSZ
+        'tr_batch_sz', 'tr_n_anchor', 'val_batch_sz', 'val_n_anchor',
+        'ts_batch_sz',
+        # Model parameters
+        'dur', 'hop', 'fs',
+        # Time-domain augmentation parameter
+        'tr_snr', 'ts_snr', 'val_snr',
+        'tr_use_bg_aug', 'ts_use_bg_aug', 'val_use_bg_aug',
+        'tr_use_ir_aug', 'ts_use_ir_aug', 'val_use_ir_aug',
+        'tr_use_speech_aug', 'ts_use_speech_aug', 'val_use_speech_aug',
+        # Source (music) file paths
+        'tr_source_fps', 'val_source_fps', 'tr_mix_fps', 'val_mix_fps',
+        'ts_dummy_db_source_fps', 'ts_query_icassp_fps', 'ts_db_icassp_fps',
+        'ts_query_db_unseen_fps',
+        # Caches
+        '_aug_fps', '_aug_blobs', '_inference_seqs', '_unseen_syn_audio_cache',
+    )
 
     def __init__(self, cfg=dict()):
         # Data location
@@ -42,6 +316,17 @@ class Dataset:
         self.ir_root_dir = cfg['DIR']['IR_ROOT_DIR']
         self.speech_root_dir = cfg['DIR']['SPEECH_ROOT_DIR']
 
+        # Source (music) sub-directories, relative to SOURCE_ROOT_DIR
+        self._val_source_dir = self.source_root_dir + "val-query-db-500-30s/"
+        self._ts_dummy_db_source_dir = \
+            self.source_root_dir + "test-dummy-db-100k-full/"
+        self._ts_query_icassp_dir = \
+            self.source_root_dir + "test-query-db-500-30s/query/"
+        self._ts_db_icassp_dir = \
+            self.source_root_dir + "test-query-db-500-30s/db/"
+        self._ts_query_db_unseen_dir = \
+            self.source_root_dir + "val-query-db-500-30s/db/"
+
         # Data selection
         self.datasel_train = cfg["DATA_SEL"]["TRAIN"]
         self.datasel_test_dummy_db = cfg["DATA_SEL"]["TEST_DUMMY_DB"]
@@ -73,11 +358,9 @@ class Dataset:
         self.ts_use_speech_aug = cfg["TD_AUG"]["TS_SPEECH_AUG"]
         self.val_use_speech_aug = cfg["TD_AUG"]["VAL_SPEECH_AUG"]
 
-        # Pre-load file paths for augmentation
-        self.tr_bg_fps = self.ts_bg_fps = self.val_bg_fps = None
-        self.tr_ir_fps = self.ts_ir_fps = self.val_ir_fps = None
-        self.tr_speech_fps = self.ts_speech_fps = self.val_speech_fps = None
-        self.__set_augmentation_fps()
+        # File paths for augmentation: indexed on first access, see
+        # __set_augmentation_fps()
+        self._aug_fps = dict()
 
         # Source (music) file paths
         self.tr_source_fps = self.val_source_fps = None
@@ -86,59 +369,203 @@ class Dataset:
         self.ts_query_icassp_fps = self.ts_db_icassp_fps = None
         self.ts_query_db_unseen_fps = None
 
-    def __set_augmentation_fps(self):
+        # Memory-mapped augmentation signals, see _build_aug_blob()
+        self._aug_blobs = dict()
+
+        # Sequences without augmentation, see _build_inference_seq()
+        self._inference_seqs = dict()
+        # 'unseen_syn' query and DB are built from the same files. The cache
+        # is per process: only used if both are read in the same process,
+        # see get_test_query_db_ds(share_decoded_audio=True).
+        self._unseen_syn_audio_cache = AudioCache()
+
+    # File lists for augmentation: {attribute: (use_aug, root, split)}.
+    # ts_speech_fps has no flag and is always available
+    # (extras/dataset2wav.py).
+    _AUG_FPS_SPECS = {
+        'tr_bg_fps': ('tr_use_bg_aug', 'bg_root_dir', 'tr/'),
+        'ts_bg_fps': ('ts_use_bg_aug', 'bg_root_dir', 'ts/'),
+        'val_bg_fps': ('val_use_bg_aug', 'bg_root_dir', 'tr/'),
+        'tr_ir_fps': ('tr_use_ir_aug', 'ir_root_dir', 'tr/'),
+        'ts_ir_fps': ('ts_use_ir_aug', 'ir_root_dir', 'ts/'),
+        'val_ir_fps': ('val_use_ir_aug', 'ir_root_dir', 'tr/'),
+        'tr_speech_fps': ('tr_use_speech_aug', 'speech_root_dir', 'train/'),
+        'ts_speech_fps': (None, 'speech_root_dir', 'test/'),
+        'val_speech_fps': ('val_use_speech_aug', 'speech_root_dir', 'dev/'),
+    }
+
+    def __set_augmentation_fps(self, names):
         """
-        Set file path lists:
+        Set file path lists for the given augmentation attributes:
 
             If validation set was not available, we replace it with subset of
-            the trainset.
+            the trainset. Lists of disabled augmentations are set as None.
+
+        Raises FileNotFoundError if the directory of an enabled augmentation
+        does not exist, rather than indexing nothing (or the wrong root).
 
         """
-        # File lists for Augmentations
-        if self.tr_use_bg_aug:
-            self.tr_bg_fps = sorted(
-                glob.glob(self.bg_root_dir + "tr/**/*.wav", recursive=True)
-            )
-        if self.ts_use_bg_aug:
-            self.ts_bg_fps = sorted(
-                glob.glob(self.bg_root_dir + "ts/**/*.wav", recursive=True)
-            )
-        if self.val_use_bg_aug:
-            self.val_bg_fps = sorted(
-                glob.glob(self.bg_root_dir + "tr/**/*.wav", recursive=True)
-            )
+        # Each (root, split) is indexed once. Lists are shared between
+        # attributes (e.g. tr_bg_fps and val_bg_fps), as they are read-only.
+        pending = dict()
+        for name in names:
+            if name in self._aug_fps:
+                continue
+            use_aug, root_attr, split = self._AUG_FPS_SPECS[name]
+            if use_aug is not None and not getattr(self, use_aug):
+                self._aug_fps[name] = None
+                continue
+            root = getattr(self, root_attr)
+            # One stat() before walking anything.
+            if not os.path.isdir(root + split):
+                if use_aug is not None:
+                    raise FileNotFoundError(
+                        f'Cannot find {root + split} for {name} ({use_aug})')
+                warnings.warn(f'Cannot find {root + split}: {name} is empty')
+                self._aug_fps[name] = _as_path_array([])
+                continue
+            pending[name] = (root, split)
+
+        # One walk per root for all of its splits. The walks are I/O-bound
+        # and independent: run them in threads.
+        splits_by_root = dict()
+        for root, split in pending.values():
+            splits_by_root.setdefault(root, set()).add(split)
+        tasks = [(root, sorted(splits))
+                 for root, splits in splits_by_root.items()]
+        if len(tasks) > 1:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                indices = list(pool.map(lambda t: _load_or_build_indices(*t),
+                                        tasks))
+        else:
+            indices = [_load_or_build_indices(*t) for t in tasks]
+        _cache = {(root, split): fps
+                  for (root, _), index in zip(tasks, indices)
+                  for split, fps in index.items()}
 
-        if self.tr_use_ir_aug:
-            self.tr_ir_fps = sorted(
-                glob.glob(self.ir_root_dir + "tr/**/*.wav", recursive=True)
-            )
-        if self.ts_use_ir_aug:
-            self.ts_ir_fps = sorted(
-                glob.glob(self.ir_root_dir + "ts/**/*.wav", recursive=True)
-            )
-        if self.val_use_ir_aug:
-            self.val_ir_fps = sorted(
-                glob.glob(self.ir_root_dir + "tr/**/*.wav", recursive=True)
-            )
+        for name, key in pending.items():
+            self._aug_fps[name] = _cache[key]
+        return
 
-        if self.tr_use_speech_aug:
-            self.tr_speech_fps = sorted(
-                glob.glob(
-                    self.speech_root_dir + "train/**/*.wav", recursive=True
-                )
-            )
-        self.ts_speech_fps = sorted(
-            glob.glob(self.speech_root_dir + "test/**/*.wav", recursive=True)
-        )
-        if self.val_use_speech_aug:
-            self.val_speech_fps = sorted(
-                glob.glob(
-                    self.speech_root_dir + "dev/**/*.wav", recursive=True
-                )
+    def __get_augmentation_fps(self, name):
+        if name not in self._aug_fps:
+            self.__set_augmentation_fps([name])
+        return self._aug_fps[name]
+
+    def _build_aug_blob(self, fps, out_path, fs, quantize=True):
+        """
+        WavBlob of the augmentation files fps, stored at out_path.
+
+        The blob is built on first use and reused as long as it was built
+        from the same file list and quantization (int8 or int16). Returns
+        None if it cannot be built (e.g. read-only dataset, or not mono
+        16-bit files): the augmentation files are then read one by one as
+        before. Failed builds are not retried, see _build_wav_blob().
+
+        """
+        if out_path not in self._aug_blobs:
+            try:
+                blob = WavBlob(out_path)
+                if not blob.matches(fps, quantize):
+                    blob = None
+            except (OSError, ValueError, KeyError):
+                blob = None
+            if blob is None:
+                blob = _build_wav_blob(fps, out_path, fs, quantize)
+            self._aug_blobs[out_path] = blob
+        return self._aug_blobs[out_path]
+
+    def __get_augmentation_blob(self, name):
+        """ WavBlob of an augmentation file list, or None if disabled. """
+        fps = self.__get_augmentation_fps(name)
+        if fps is None:
+            return None
+        _, root_attr, split = self._AUG_FPS_SPECS[name]
+        out_path = getattr(self, root_attr) + split.rstrip(os.sep) + '.wav.bin'
+        # BG and speech are mixed at random SNR: int8 is enough for them.
+        # IRs keep int16, as their decaying tails would fall below 8 bits.
+        quantize = root_attr != 'ir_root_dir'
+        return self._build_aug_blob(fps, out_path, self.fs, quantize)
+
+    @property
+    def tr_bg_fps(self):
+        return self.__get_augmentation_fps('tr_bg_fps')
+
+    @property
+    def ts_bg_fps(self):
+        return self.__get_augmentation_fps('ts_bg_fps')
+
+    @property
+    def val_bg_fps(self):
+        return self.__get_augmentation_fps('val_bg_fps')
+
+    @property
+    def tr_ir_fps(self):
+        return self.__get_augmentation_fps('tr_ir_fps')
+
+    @property
+    def ts_ir_fps(self):
+        return self.__get_augmentation_fps('ts_ir_fps')
+
+    @property
+    def val_ir_fps(self):
+        return self.__get_augmentation_fps('val_ir_fps')
+
+    @property
+    def tr_speech_fps(self):
+        return self.__get_augmentation_fps('tr_speech_fps')
+
+    @property
+    def ts_speech_fps(self):
+        return self.__get_augmentation_fps('ts_speech_fps')
+
+    @property
+    def val_speech_fps(self):
+        return self.__get_augmentation_fps('val_speech_fps')
+
+    def _build_inference_seq(self, fps, shared_audio_cache=None, workers=1,
+                             max_cached=8):
+        """
+        Sequence of anchors only, without augmentations nor dropped samples.
+
+        Used for the fingerprint generation. Sequences are kept per fps
+        object, audio cache and workers (up to max_cached), so that calling
+        get_*_ds() again with the same arguments reuses the segment list
+        built by genUnbalSequence. A returned sequence is never modified
+        by later calls.
+
+        """
+        key = (id(fps), id(shared_audio_cache), workers)
+        if key not in self._inference_seqs:
+            ds = genUnbalSequence(
+                fns_source_event_list=fps,
+                fns_mix_event_list=fps, # No mix files for inference.
+                bsz=self.ts_batch_sz,
+                n_anchor=self.ts_batch_sz, # Only anchors...
+                duration=self.dur,
+                hop=self.hop,
+                fs=self.fs,
+                shuffle=False,
+                random_offset_anchor=False,
+                drop_the_last_non_full_batch=False,
+                shared_audio_cache=shared_audio_cache,
+                n_workers=workers,
             )
-        return
+            if len(self._inference_seqs) >= max_cached:
+                del self._inference_seqs[next(iter(self._inference_seqs))]
+            # Keys stay unique as long as the objects are kept alive here.
+            self._inference_seqs[key] = (fps, shared_audio_cache, ds)
+        return self._inference_seqs[key][-1]
+
+    def get_train_ds(self, reduce_items_p=0, workers=1, prefetch=2):
+        """
+        workers: (int) threads loading the files of a batch. The default 1
+            uses no threads. Keep it with a multiprocessing OrderedEnqueuer
+            (trainer.py, generate.py), whose worker processes already load
+            batches in parallel.
+        prefetch: (int) batches prepared in advance when iterating.
 
-    def get_train_ds(self, reduce_items_p=0):
+        """
         # Source (music) file paths for train set
         if self.datasel_train == '10k_icassp':
             _prefix = 'train-10k-30s/'
@@ -146,11 +573,13 @@ class Dataset:
             _prefix = 'dataset/'
         else:
             raise NotImplementedError(self.datasel_train)
-        # TODO Change to reading from .lst file
-        self.tr_source_fps = sorted(
-            glob.glob(self.source_root_dir + '**/*.wav', recursive=True))
-        self.tr_mix_fps = sorted(
-            glob.glob(self.mix_root_dir + '**/*.wav', recursive=True))
+        self.__set_augmentation_fps(
+            ['tr_bg_fps', 'tr_ir_fps', 'tr_speech_fps'])
+        # File lists are kept for later calls (e.g. one call per epoch).
+        if self.tr_source_fps is None:
+            self.tr_source_fps = _load_or_build_index(self.source_root_dir)
+        if self.tr_mix_fps is None:
+            self.tr_mix_fps = _load_or_build_index(self.mix_root_dir)
 
         ds = genUnbalSequence(
             fns_source_event_list=self.tr_source_fps, # Source song file paths as a list
@@ -162,94 +591,100 @@ class Dataset:
             fs=self.fs,
             shuffle=True,
             random_offset_anchor=True,
-            bg_mix_parameter=[self.tr_use_bg_aug, self.tr_bg_fps, self.tr_snr],
-            ir_mix_parameter=[self.tr_use_ir_aug, self.tr_ir_fps],
+            bg_mix_parameter=[
+                self.tr_use_bg_aug,
+                self.tr_bg_fps,
+                self.tr_snr,
+                self.__get_augmentation_blob('tr_bg_fps'),
+            ],
+            ir_mix_parameter=[
+                self.tr_use_ir_aug,
+                self.tr_ir_fps,
+                self.__get_augmentation_blob('tr_ir_fps'),
+            ],
             speech_mix_parameter=[
                 self.tr_use_speech_aug,
                 self.tr_speech_fps,
                 self.tr_snr,
+                self.__get_augmentation_blob('tr_speech_fps'),
             ],
             reduce_items_p=reduce_items_p,
+            n_workers=workers,
         )
-        return ds
+        return PrefetchSequence(ds, n_prefetch=prefetch)
 
-    def get_val_ds(self, max_song=500):
+    def get_val_ds(self, max_song=500, workers=1, prefetch=2):
         # Source (music) file paths for validation set.
         """
         max_song: (int) <= 500.
+        workers, prefetch: see get_train_ds().
 
         """
-        self.val_source_fps = sorted(
-            glob.glob(
-                self.source_root_dir + "val-query-db-500-30s/" + "**/*.wav",
-                recursive=True,
-            )
-        )[:max_song]
+        self.__set_augmentation_fps(
+            ['val_bg_fps', 'val_ir_fps', 'val_speech_fps'])
+        self.val_source_fps = _load_or_build_index(
+            self._val_source_dir)[:max_song]
 
         ds = genUnbalSequence(
-            self.val_source_fps,
-            self.val_batch_sz,
-            self.val_n_anchor,
-            self.dur,
-            self.hop,
-            self.fs,
+            fns_source_event_list=self.val_source_fps,
+            fns_mix_event_list=self.val_source_fps, # No mix files for val.
+            bsz=self.val_batch_sz,
+            n_anchor=self.val_n_anchor,
+            duration=self.dur,
+            hop=self.hop,
+            fs=self.fs,
             shuffle=False,
             random_offset_anchor=False,
             bg_mix_parameter=[
                 self.val_use_bg_aug,
                 self.val_bg_fps,
                 self.val_snr,
+                self.__get_augmentation_blob('val_bg_fps'),
+            ],
+            ir_mix_parameter=[
+                self.val_use_ir_aug,
+                self.val_ir_fps,
+                self.__get_augmentation_blob('val_ir_fps'),
             ],
-            ir_mix_parameter=[self.val_use_ir_aug, self.val_ir_fps],
             speech_mix_parameter=[
                 self.val_use_speech_aug,
                 self.val_speech_fps,
                 self.val_snr,
+                self.__get_augmentation_blob('val_speech_fps'),
             ],
+            n_workers=workers,
         )
-        return ds
+        return PrefetchSequence(ds, n_prefetch=prefetch)
 
-    def get_test_dummy_db_ds(self):
+    def get_test_dummy_db_ds(self, workers=1, prefetch=2):
         """
         Test-dummy-DB without augmentation:
 
             In this case, high-speed fingerprinting is possible without
             augmentation by setting ts_n_anchor=ts_batch_sz.
 
+        workers, prefetch: see get_train_ds().
+
         """
         # Source (music) file paths for test-dummy-DB set
-        self.ts_dummy_db_source_fps = sorted(
-            glob.glob(
-                self.source_root_dir + "test-dummy-db-100k-full/" + "**/*.wav",
-                recursive=True,
-            )
-        )
-        if self.datasel_test_dummy_db in ["10k_full", "10k_30s"]:
-            self.ts_dummy_db_source_fps = self.ts_dummy_db_source_fps[:10000]
-        elif self.datasel_test_dummy_db == "100k_full_icassp":
-            self.ts_dummy_db_source_fps = self.ts_dummy_db_source_fps
-        elif self.datasel_test_dummy_db.isnumeric():
-            self.ts_dummy_db_source_fps = self.ts_dummy_db_source_fps[
-                : int(self.datasel_test_db)
-            ]
-        else:
-            raise NotImplementedError(self.datasel_test_dummy_db)
-
-        _ts_n_anchor = self.ts_batch_sz
-        ds = genUnbalSequence(
-            self.ts_dummy_db_source_fps,
-            self.ts_batch_sz,
-            _ts_n_anchor,
-            self.dur,
-            self.hop,
-            self.fs,
-            shuffle=False,
-            random_offset_anchor=False,
-            drop_the_last_non_full_batch=False,
-        )  # No augmentations...
-        return ds
-
-    def get_test_query_db_ds(self, datasel=None):
+        if self.ts_dummy_db_source_fps is None:
+            fps = _load_or_build_index(self._ts_dummy_db_source_dir)
+            if self.datasel_test_dummy_db in ["10k_full", "10k_30s"]:
+                fps = fps[:10000]
+            elif self.datasel_test_dummy_db == "100k_full_icassp":
+                pass
+            elif self.datasel_test_dummy_db.isnumeric():
+                fps = fps[:int(self.datasel_test_dummy_db)]
+            else:
+                raise NotImplementedError(self.datasel_test_dummy_db)
+            self.ts_dummy_db_source_fps = fps
+
+        ds = self._build_inference_seq(self.ts_dummy_db_source_fps,
+                                       workers=workers)
+        return PrefetchSequence(ds, n_prefetch=prefetch)
+
+    def get_test_query_db_ds(self, datasel=None, workers=1, prefetch=2,
+                             share_decoded_audio=False):
         """
         To select test dataset, you can use config file or datasel parameter.
 
@@ -258,129 +693,101 @@ class Dataset:
             'unseen_icassp' will use pre-defined queries and DB
             'unseen_syn' will synthesize queries from DB in real-time.
 
+        share_decoded_audio: (bool) with 'unseen_syn', let query and DB share
+        one AudioCache (up to 1 GiB), so that each file is decoded once. Only
+        set it if both are read in the same process (e.g. iterating over
+        them, or OrderedEnqueuer with use_multiprocessing=False): each worker
+        process of OrderedEnqueuer(use_multiprocessing=True) would fill its
+        own copy, with nothing shared between query and DB. Default is False.
+
+        workers, prefetch: see get_train_ds().
+
         Returns
         -------
         (ds_query, ds_db)
 
         """
         if datasel:
-            self.datasel
+            self.datasel_test_query_db = datasel
 
         # 'unseen_icassp'
         if self.datasel_test_query_db == "unseen_icassp":
-            self.ts_query_icassp_fps = sorted(
-                glob.glob(
-                    self.source_root_dir
-                    + "test-query-db-500-30s/"
-                    + "query/**/*.wav",
-                    recursive=True,
-                )
-            )
-            self.ts_db_icassp_fps = sorted(
-                glob.glob(
-                    self.source_root_dir
-                    + "test-query-db-500-30s/"
-                    + "db/**/*.wav",
-                    recursive=True,
-                )
-            )
-
-            _ts_n_anchor = self.ts_batch_sz
-            ds_query = genUnbalSequence(
-                self.ts_query_icassp_fps,
-                self.ts_batch_sz,
-                _ts_n_anchor,
-                self.dur,
-                self.hop,
-                self.fs,
-                shuffle=False,
-                random_offset_anchor=False,
-                drop_the_last_non_full_batch=False,
-            )  # No augmentations...
-            ds_db = genUnbalSequence(
-                self.ts_db_icassp_fps,
-                self.ts_batch_sz,
-                _ts_n_anchor,
-                self.dur,
-                self.hop,
-                self.fs,
-                shuffle=False,
-                random_offset_anchor=False,
-                drop_the_last_non_full_batch=False,
-            )  # No augmentations...
-            return ds_query, ds_db
+            if self.ts_query_icassp_fps is None:
+                self.ts_query_icassp_fps = _load_or_build_index(
+                    self._ts_query_icassp_dir)
+            if self.ts_db_icassp_fps is None:
+                self.ts_db_icassp_fps = _load_or_build_index(
+                    self._ts_db_icassp_dir)
+
+            # No augmentations...
+            ds_query = self._build_inference_seq(self.ts_query_icassp_fps,
+                                                 workers=workers)
+            ds_db = self._build_inference_seq(self.ts_db_icassp_fps,
+                                              workers=workers)
+            return (PrefetchSequence(ds_query, n_prefetch=prefetch),
+                    PrefetchSequence(ds_db, n_prefetch=prefetch))
 
         # 'unseen_syn'
         elif self.datasel_test_query_db == "unseen_syn":
-            self.ts_query_db_unseen_fps = sorted(
-                glob.glob(
-                    self.source_root_dir
-                    + "val-query-db-500-30s/"
-                    + "db/**/*.wav",
-                    recursive=True,
-                )
-            )
+            self.__set_augmentation_fps(['ts_bg_fps', 'ts_ir_fps'])
+            if self.ts_query_db_unseen_fps is None:
+                self.ts_query_db_unseen_fps = _load_or_build_index(
+                    self._ts_query_db_unseen_dir)
+
+            if share_decoded_audio:
+                audio_cache = self._unseen_syn_audio_cache
+            else:
+                audio_cache = None
 
             _query_ts_batch_sz = self.ts_batch_sz * 2
             _query_ts_n_anchor = self.ts_batch_sz
 
             ds_query = genUnbalSequence(
-                self.ts_query_db_unseen_fps,
-                _query_ts_batch_sz,
-                _query_ts_n_anchor,
-                self.dur,
-                self.hop,
-                self.fs,
+                fns_source_event_list=self.ts_query_db_unseen_fps,
+                fns_mix_event_list=self.ts_query_db_unseen_fps, # No mix files
+                bsz=_query_ts_batch_sz,
+                n_anchor=_query_ts_n_anchor,
+                duration=self.dur,
+                hop=self.hop,
+                fs=self.fs,
                 shuffle=False,
                 random_offset_anchor=False,
                 bg_mix_parameter=[
                     self.ts_use_bg_aug,
                     self.ts_bg_fps,
                     self.ts_snr,
+                    self.__get_augmentation_blob('ts_bg_fps'),
+                ],
+                ir_mix_parameter=[
+                    self.ts_use_ir_aug,
+                    self.ts_ir_fps,
+                    self.__get_augmentation_blob('ts_ir_fps'),
                 ],
-                ir_mix_parameter=[self.ts_use_ir_aug, self.ts_ir_fps],
                 speech_mix_parameter=[False],
                 reduce_batch_first_half=True,
                 drop_the_last_non_full_batch=False,
+                shared_audio_cache=audio_cache,
+                n_workers=workers,
             )
 
-            _db_ts_n_anchor = self.ts_batch_sz
-            ds_db = genUnbalSequence(
+            # Same files as the queries: decoded once with the shared cache.
+            ds_db = self._build_inference_seq(
                 self.ts_query_db_unseen_fps,
-                self.ts_batch_sz,
-                _db_ts_n_anchor,
-                self.dur,
-                self.hop,
-                self.fs,
-                shuffle=False,
-                random_offset_anchor=False,
-                drop_the_last_non_full_batch=False,
-            )
-            return ds_query, ds_db
+                shared_audio_cache=audio_cache,
+                workers=workers)
+            return (PrefetchSequence(ds_query, n_prefetch=prefetch),
+                    PrefetchSequence(ds_db, n_prefetch=prefetch))
         else:
             raise NotImplementedError(self.datasel_test_query_db)
 
-    def get_custom_db_ds(self, source: str, isdir):
+    def get_custom_db_ds(self, source: str, isdir, workers=1, prefetch=2):
         """Construc DB (or query) from custom source files."""
 
         if isdir is True:
-            fps = sorted(glob.glob(os.path.join(source + "/**/*.wav"), recursive=True))
+            fps = _index_wavs(source)
         else:
-            fps = []
             with open(source, "r") as fin:
-                for l in fin:
-                    fps.append(l.split("\n")[0])
-            fps = sorted(fps)
-        _ts_n_anchor = self.ts_batch_sz  # Only anchors...
-        ds = genUnbalSequence(
-            fps,
-            self.ts_batch_sz,
-            _ts_n_anchor,
-            self.dur,
-            self.hop,
-            self.fs,
-            shuffle=False,
-            random_offset_anchor=False,
-            drop_the_last_non_full_batch=False,
-        )  # No augmentations, No drop-samples.
-        return ds
+                fps = fin.read().splitlines()
+        fps = _as_path_array(fps)
+        ds = self._build_inference_seq(fps, workers=workers)
+        return PrefetchSequence(ds, n_prefetch=prefetch)
@@ -3,7 +3,10 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 """ audio_utils.py """
+import os
+import threading
 import wave
+from collections import OrderedDict
 import numpy as np
 
 
@@ -228,17 +231,205 @@ def get_fns_seg_list(fns_source_list=[],
     return fns_source_event_seg_list, fns_mix_event_seg_list 
 
 
+def read_wav(filename=str()):
+    """ Read a whole 16-bit wav file as 1D float32 array in [-1, 1). """
+    pt_wav = wave.open(filename, 'r')
+    x = pt_wav.readframes(pt_wav.getnframes())
+    pt_wav.close()
+    return np.frombuffer(x, dtype=np.int16).astype(np.float32) / 2**15
+
+
+class AudioCache:
+    """
+    LRU cache of decoded wav files, shared by several data loaders.
+
+    cache[filename] returns the whole signal as read_wav() does, decoding the
+    file on the first access only. When the decoded signals exceed max_bytes,
+    the least recently used ones are dropped. Thread-safe.
+
+    """
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._signals = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signals)
+
+    def __contains__(self, filename):
+        return filename in self._signals
+
+    def __getitem__(self, filename):
+        with self._lock:
+            if filename in self._signals:
+                self._signals.move_to_end(filename)
+                return self._signals[filename]
+
+        x = read_wav(filename) # Decode without holding the lock.
+        with self._lock:
+            if filename not in self._signals:
+                self._signals[filename] = x
+                self.n_bytes += x.nbytes
+            while self.n_bytes > self.max_bytes and len(self._signals) > 1:
+                _, _x = self._signals.popitem(last=False)
+                self.n_bytes -= _x.nbytes
+        return x
+
+
+class _ScaledSignal:
+    """ Integer samples, sliced as float (samples * scale) like load_audio(). """
+    def __init__(self, samples, scale):
+        self.samples = samples
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx] * self.scale
+
+
+class WavBlob:
+    """
+    Set of mono 16-bit wav files stored as one memory-mapped file.
+
+    blob[filename] returns the whole signal of a file (see load_audio's
+    audio_cache), read from the page cache without opening nor parsing the
+    original wav file. Build it once with WavBlob.build(fps, path, fs);
+    'path' holds the concatenated samples and 'path.npz' the
+    {fps, sizes, mtimes, offsets, lengths, scales} index. The sizes and
+    mtimes of the original files are checked by matches(), so that a file
+    replaced in place is not read from a stale blob.
+
+    By default, samples are quantized to int8 with a per-file scale (peak
+    amplitude / 127). This halves the size and the memory traffic compared
+    with int16. Use quantize=False to keep the original int16 samples.
+
+    """
+    def __init__(self, path):
+        with np.load(path + '.npz', allow_pickle=False) as index:
+            self.fps = index['fps']
+            self.sizes, self.mtimes = index['sizes'], index['mtimes']
+            offsets, lengths = index['offsets'], index['lengths']
+            scales = index['scales']
+            self.dtype = np.dtype(str(index['dtype']))
+        n_total = int(offsets[-1] + lengths[-1]) if len(offsets) else 0
+        if os.path.getsize(path) != n_total * self.dtype.itemsize:
+            raise ValueError(f'{path} does not match its index.')
+        if n_total > 0:
+            self._samples = np.memmap(path, dtype=self.dtype, mode='r')
+        else:
+            self._samples = np.zeros(0, dtype=self.dtype)
+        self._index = {
+            fp: (int(o), int(n), float(c))
+            for fp, o, n, c in zip(self.fps, offsets, lengths, scales)
+        }
+
+    @classmethod
+    def build(cls, fps, path, fs, quantize=True):
+        """ Decode fps into a new blob at path, and return it. """
+        if os.path.exists(path + '.npz'):
+            os.remove(path + '.npz') # Invalidate the previous blob first.
+        dtype = np.dtype(np.int8 if quantize else np.int16)
+        sizes, mtimes, offsets, lengths, scales = [], [], [], [], []
+        n_total = 0
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as fout:
+                for fp in fps:
+                    # Stat before reading: a change during the build is
+                    # detected by matches() later.
+                    st = os.stat(fp)
+                    pt_wav = wave.open(fp, 'r')
+                    if pt_wav.getframerate() != fs:
+                        raise ValueError(
+                            'Sample rate should be {} but got {}'.format(
+                                str(fs), str(pt_wav.getframerate())))
+                    if pt_wav.getnchannels() != 1 or pt_wav.getsampwidth() != 2:
+                        raise ValueError(f'{fp} is not mono 16-bit PCM.')
+                    x = pt_wav.readframes(pt_wav.getnframes())
+                    pt_wav.close()
+                    x = np.frombuffer(x, dtype=np.int16)
+
+                    scale = 2.**-15
+                    if quantize:
+                        peak = np.max(np.abs(x.astype(np.int32)), initial=0)
+                        step = max(peak, 1) / 127
+                        x = np.round(x / step).astype(np.int8)
+                        scale = step * 2.**-15
+                    fout.write(x.tobytes())
+                    sizes.append(st.st_size)
+                    mtimes.append(st.st_mtime_ns)
+                    offsets.append(n_total)
+                    lengths.append(len(x))
+                    scales.append(scale)
+                    n_total += len(x)
+            os.replace(tmp, path)
+
+            # The index is written last: a blob without it is never used.
+            with open(tmp, 'wb') as fout:
+                np.savez(fout,
+                         fps=np.asarray(fps, dtype=str),
+                         sizes=np.asarray(sizes, dtype=np.int64),
+                         mtimes=np.asarray(mtimes, dtype=np.int64),
+                         offsets=np.asarray(offsets, dtype=np.int64),
+                         lengths=np.asarray(lengths, dtype=np.int64),
+                         scales=np.asarray(scales, dtype=np.float64),
+                         dtype=dtype.str)
+            os.replace(tmp, path + '.npz')
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return cls(path)
+
+    def matches(self, fps, quantize=True):
+        """
+        True if the blob was built from these file paths and options, and
+        none of the files changed since (same size and mtime, one stat() per
+        file).
+
+        """
+        if self.dtype != np.dtype(np.int8 if quantize else np.int16):
+            return False
+        if len(self.fps) != len(fps) or any(
+                a != b for a, b in zip(self.fps, fps)):
+            return False
+        try:
+            for fp, size, mtime in zip(fps, self.sizes, self.mtimes):
+                st = os.stat(fp)
+                if st.st_size != size or st.st_mtime_ns != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    def __getitem__(self, filename):
+        offset, length, scale = self._index[filename]
+        return _ScaledSignal(self._samples[offset:offset + length], scale)
+
+
 def load_audio(filename=str(),
                seg_start_sec=float(),
                offset_sec=0.0,
                seg_length_sec=float(),
                seg_pad_offset_sec=0.0,
                fs=22050,
-               amp_mode='normal'):
+               amp_mode='normal',
+               audio_cache=None):
     """
         Open file to get file info --> Calulate index range
         --> Load sample by index --> Padding --> Max-Normalize --> Out
-        
+
+        With audio_cache (e.g. AudioCache or WavBlob), the segment is sliced
+        from the signal audio_cache[filename] instead of read from the file.
+
     """
     start_frame_idx = np.floor((seg_start_sec + offset_sec) * fs).astype(int)
     seg_length_frame = np.floor(seg_length_sec * fs).astype(int)
@@ -248,7 +439,9 @@ def load_audio(filename=str(),
     file_ext = filename[-3:]
     #print(start_frame_idx, end_frame_idx)
 
-    if file_ext == 'wav':
+    if file_ext == 'wav' and audio_cache is not None:
+        x = audio_cache[filename][start_frame_idx:end_frame_idx]
+    elif file_ext == 'wav':
         pt_wav = wave.open(filename, 'r')
         pt_wav.setpos(start_frame_idx)
         x = pt_wav.readframes(end_frame_idx - start_frame_idx)
@@ -278,7 +471,8 @@ def load_audio_multi_start(filename=str(),
                            seg_start_sec_list=[],
                            seg_length_sec=float(),
                            fs=22050,
-                           amp_mode='normal'):
+                           amp_mode='normal',
+                           audio_cache=None):
     """ Load_audio wrapper for loading audio with multiple start indices. """
     # assert(len(seg_start_sec_list)==len(seg_length_sec))
     out = None
@@ -286,7 +480,8 @@ def load_audio_multi_start(filename=str(),
         x = load_audio(filename=filename,
                        seg_start_sec=seg_start_sec,
                        seg_length_sec=seg_length_sec,
-                       fs=8000)
+                       fs=8000,
+                       audio_cache=audio_cache)
         x = x.reshape((1, -1))
         if out is None:
             out = x
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 """ dataloader_keras.py """
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tensorflow.keras.utils import Sequence
 from model.utils.audio_utils import (bg_mix_batch, ir_aug_batch, load_audio,
                                      get_fns_seg_list, load_audio_multi_start)
@@ -29,7 +33,9 @@ class genUnbalSequence(Sequence):
         reduce_items_p=0,
         reduce_batch_first_half=False,
         experimental_mode=False,
-        drop_the_last_non_full_batch = True
+        drop_the_last_non_full_batch = True,
+        shared_audio_cache=None,
+        n_workers=1
         ):
         """
         
@@ -64,10 +70,14 @@ class genUnbalSequence(Sequence):
             For example, 0.4 means max 40 % overlaps. The default is 0.4.
         bg_mix_parameter : list([(bool), list(str), (int, int)]), optional
             [True, BG_FILEPATHS, (MIN_SNR, MAX_SNR)]. The default is [False].
+            An optional 4th element, e.g. a WavBlob of BG_FILEPATHS, is used
+            to read the BG signals (see load_audio's audio_cache).
         ir_mix_parameter : list([(bool), list(str)], optional
-            [True, BG_FILEPATHS, (MIN_SNR, MAX_SNR)]. The default is [False].
+            [True, IR_FILEPATHS]. The default is [False]. An optional 3rd
+            element is used to read the IR signals.
         speech_mix_parameter : list([(bool), list(str), (int, int)]), optional
             [True, SPEECH_FILEPATHS, (MIN_SNR, MAX_SNR)]. The default is [False].
+            An optional 4th element is used to read the speech signals.
         reduce_items_p : (int), optional
             Reduce dataset size to percent (%). Useful when debugging code with samll            data. The default is 0.
         reduce_batch_first_half : (bool), optional
@@ -79,6 +89,16 @@ class genUnbalSequence(Sequence):
             the multiple positive samples.. The default is False.
         drop_the_last_non_full_batch : (bool), optional
             Set as False in test. Default is True.
+        shared_audio_cache : (AudioCache), optional
+            Cache of decoded source/mix files. Sharing one between sequences
+            built from the same files decodes each file only once, as long as
+            they are read in the same process: worker processes (e.g.
+            OrderedEnqueuer with use_multiprocessing=True) each fill their own
+            copy. Default is None (read segments from the files).
+        n_workers : (int), optional
+            Number of threads loading the files of a batch. Random offsets are
+            still drawn in the calling thread, so batches do not depend on it.
+            The default is 1 (no threads).
 
         """
         self.bsz = bsz
@@ -104,16 +124,23 @@ class genUnbalSequence(Sequence):
         self.ir_mix = ir_mix_parameter[0]
         self.speech_mix = speech_mix_parameter[0]
 
+        self.bg_audio = self.ir_audio = self.speech_audio = None
         if self.bg_mix == True:
             fns_bg_list = bg_mix_parameter[1]
             self.bg_snr_range = bg_mix_parameter[2]
+            if len(bg_mix_parameter) > 3:
+                self.bg_audio = bg_mix_parameter[3]
 
         if self.ir_mix == True:
             fns_ir_list = ir_mix_parameter[1]
+            if len(ir_mix_parameter) > 2:
+                self.ir_audio = ir_mix_parameter[2]
 
         if self.speech_mix == True:
             fns_speech_list = speech_mix_parameter[1]
             self.speech_snr_range = speech_mix_parameter[2]
+            if len(speech_mix_parameter) > 3:
+                self.speech_audio = speech_mix_parameter[3]
 
         
         if self.seg_mode in {'random_oneshot', 'all'}:
@@ -145,9 +172,11 @@ class genUnbalSequence(Sequence):
         else:
             self.index_event = np.arange(self.n_samples)
 
+        # BG/speech/IRs have no mix files: the second list returned by
+        # get_fns_seg_list() is a copy of the first one.
         if self.bg_mix == True:
-            self.fns_bg_seg_list = get_fns_seg_list(fns_bg_list, 'all',
-                                                    self.fs, self.duration)
+            self.fns_bg_seg_list, _ = get_fns_seg_list(
+                fns_bg_list, fns_bg_list, 'all', self.fs, self.duration)
             self.n_bg_samples = len(self.fns_bg_seg_list)
             if self.shuffle == True:
                 self.index_bg = np.random.permutation(self.n_bg_samples)
@@ -157,8 +186,9 @@ class genUnbalSequence(Sequence):
             pass
 
         if self.speech_mix == True:
-            self.fns_speech_seg_list = get_fns_seg_list(
-                fns_speech_list, 'all', self.fs, self.duration)
+            self.fns_speech_seg_list, _ = get_fns_seg_list(
+                fns_speech_list, fns_speech_list, 'all', self.fs,
+                self.duration)
             self.n_speech_samples = len(self.fns_speech_seg_list)
             if self.shuffle == True:
                 self.index_speech = np.random.permutation(
@@ -167,8 +197,8 @@ class genUnbalSequence(Sequence):
                 self.index_speech = np.arange(self.n_speech_samples)
 
         if self.ir_mix == True:
-            self.fns_ir_seg_list = get_fns_seg_list(fns_ir_list, 'first',
-                                                    self.fs, self.duration)
+            self.fns_ir_seg_list, _ = get_fns_seg_list(
+                fns_ir_list, fns_ir_list, 'first', self.fs, self.duration)
             self.n_ir_samples = len(self.fns_ir_seg_list)
             if self.shuffle == True:
                 self.index_ir = np.random.permutation(self.n_ir_samples)
@@ -177,6 +207,11 @@ class genUnbalSequence(Sequence):
         else:
             pass
 
+        self.shared_audio_cache = shared_audio_cache
+        self.n_workers = n_workers
+        self._executor = None
+        self._executor_pid = None
+
         self.reduce_items_p = reduce_items_p
         assert(reduce_items_p <= 100)
         self.reduce_batch_first_half = reduce_batch_first_half
@@ -188,6 +223,24 @@ class genUnbalSequence(Sequence):
                 self.n_pos_per_anchor) * self.hop
 
 
+    def __getstate__(self):
+        # Thread pools can not be pickled (e.g. to spawned enqueuer workers).
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+
+    def __map(self, fn, items):
+        """ list(map(fn, items)), using n_workers threads if n_workers > 1. """
+        if self.n_workers <= 1:
+            return [fn(item) for item in items]
+        # Threads do not survive fork(): each process makes its own pool.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            self._executor_pid = os.getpid()
+        return list(self._executor.map(fn, items))
+
+
     def __len__(self):
         """ Returns the number of batches per epoch. """
         if self.reduce_items_p != 0:
@@ -316,10 +369,43 @@ class genUnbalSequence(Sequence):
             return Xa_batch, Xp_batch
 
 
+    def advise_batch_files(self, idx):
+        """
+        Ask the OS to start reading the source/mix files of batch idx, so that
+        they are already in the page cache when that batch is loaded.
+
+        Only useful if batch idx is really the next one to be loaded, by the
+        same consumer: PrefetchSequence calls it when iterating in order.
+        Random access (e.g. shuffled or multi-worker enqueuers) does not.
+
+        """
+        if not hasattr(os, 'posix_fadvise') or idx >= len(self):
+            return
+        index_anchor_for_batch = self.index_event[idx *
+                                                  self.n_anchor:(idx + 1) *
+                                                  self.n_anchor]
+        fns = set()
+        for i in index_anchor_for_batch:
+            fns.add(self.fns_source_event_seg_list[i][0])
+            fns.add(self.fns_mix_event_seg_list[i][0])
+
+        for fn in fns:
+            try:
+                fd = os.open(fn, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                # The hint persists after closing the file.
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
     def __event_batch_load(self, anchor_idx_list):
         """ Get Xa_batch and Xp_batch for anchor (original) and positive (replica) samples. """
-        Xa_batch = None
-        Xp_batch = None
+        start_sec_lists = []
         for idx in anchor_idx_list:  # idx: index for one sample
             pos_start_sec_list = []
             # fns_source_event_seg_list = [[filename, seg_idx, offset_min, offset_max], [ ... ] , ... [ ... ]]
@@ -385,22 +471,31 @@ class genUnbalSequence(Sequence):
             load audio returns: [anchor, pos1, pos2,..pos_n]
             """
             #print(self.fns_source_event_seg_list[idx])
-            start_sec_list = np.concatenate(
-                ([anchor_start_sec], pos_start_sec_list))
+            start_sec_lists.append(np.concatenate(
+                ([anchor_start_sec], pos_start_sec_list)))
+
+        def load(i):
+            idx, start_sec_list = anchor_idx_list[i], start_sec_lists[i]
             x_source = load_audio_multi_start(self.fns_source_event_seg_list[idx][0],
                                         start_sec_list, self.duration, self.fs,
-                                        self.amp_mode)  # x_source: ((1+n_pos)),T)
+                                        self.amp_mode,
+                                        self.shared_audio_cache)  # x_source: ((1+n_pos)),T)
             x_mix = load_audio_multi_start(self.fns_mix_event_seg_list[idx][0],
                                         start_sec_list, self.duration, self.fs,
-                                        self.amp_mode)  # x_mix: ((1+n_pos)),T)
+                                        self.amp_mode,
+                                        self.shared_audio_cache)  # x_mix: ((1+n_pos)),T)
+            return x_source[0, :], x_mix[0, :]
 
+        Xa_batch = None
+        Xp_batch = None
+        for x_source, x_mix in self.__map(load, range(len(anchor_idx_list))):
             if Xa_batch is None and Xp_batch is None:
-                Xa_batch = x_source[0, :].reshape((1, -1))
-                Xp_batch = x_mix[0, :].reshape((1, -1))
+                Xa_batch = x_source.reshape((1, -1))
+                Xp_batch = x_mix.reshape((1, -1))
             else:
-                Xa_batch = np.vstack((Xa_batch, x_source[0, :].reshape(
+                Xa_batch = np.vstack((Xa_batch, x_source.reshape(
                     (1, -1))))  # Xa_batch: (n_anchor, T)
-                Xa_batch = np.vstack((Xp_batch, x_mix[0, :].reshape(
+                Xa_batch = np.vstack((Xp_batch, x_mix.reshape(
                     (1, -1))))  # Xp_batch: (n_anchor, T)
         return Xa_batch, Xp_batch
 
@@ -493,11 +588,11 @@ class genUnbalSequence(Sequence):
 
 
     def __bg_batch_load(self, idx_list):
-        X_bg_batch = None  # (n_batch+n_batch//n_class, fs*k)
         random_offset_sec = np.random.randint(
             0, self.duration * self.fs / 2, size=len(idx_list)) / self.fs
-        for i, idx in enumerate(idx_list):
-            idx = idx % self.n_bg_samples
+
+        def load(i):
+            idx = idx_list[i] % self.n_bg_samples
             offset_sec = np.min(
                 [random_offset_sec[i], self.fns_bg_seg_list[idx][3] / self.fs])
 
@@ -508,24 +603,22 @@ class genUnbalSequence(Sequence):
                            seg_length_sec=self.duration,
                            seg_pad_offset_sec=0.,
                            fs=self.fs,
-                           amp_mode='normal')
-
-            X = X.reshape(1, -1)
+                           amp_mode='normal',
+                           audio_cache=self.bg_audio)
+            return X.reshape(1, -1)
 
-            if X_bg_batch is None:
-                X_bg_batch = X
-            else:
-                X_bg_batch = np.concatenate((X_bg_batch, X), axis=0)
-
-        return X_bg_batch
+        Xs = self.__map(load, range(len(idx_list)))
+        if len(Xs) == 0:
+            return None
+        return np.concatenate(Xs, axis=0)  # (n_batch+n_batch//n_class, fs*k)
 
 
     def __speech_batch_load(self, idx_list):
-        X_speech_batch = None  # (n_batch+n_batch//n_class, fs*k)
         random_offset_sec = np.random.randint(
             0, self.duration * self.fs / 2, size=len(idx_list)) / self.fs
-        for i, idx in enumerate(idx_list):
-            idx = idx % self.n_speech_samples
+
+        def load(i):
+            idx = idx_list[i] % self.n_speech_samples
             offset_sec = np.min([
                 random_offset_sec[i],
                 self.fns_speech_seg_list[idx][3] / self.fs
@@ -538,21 +631,18 @@ class genUnbalSequence(Sequence):
                            seg_length_sec=self.duration,
                            seg_pad_offset_sec=0.,
                            fs=self.fs,
-                           amp_mode='normal')
-            X = X.reshape(1, -1)
+                           amp_mode='normal',
+                           audio_cache=self.speech_audio)
+            return X.reshape(1, -1)
 
-            if X_speech_batch is None:
-                X_speech_batch = X
-            else:
-                X_speech_batch = np.concatenate((X_speech_batch, X), axis=0)
-
-        return X_speech_batch
+        Xs = self.__map(load, range(len(idx_list)))
+        if len(Xs) == 0:
+            return None
+        return np.concatenate(Xs, axis=0)  # (n_batch+n_batch//n_class, fs*k)
 
 
     def __ir_batch_load(self, idx_list):
-        X_ir_batch = None  # (n_batch+n_batch//n_class, fs*k)
-
-        for idx in idx_list:
+        def load(idx):
             idx = idx % self.n_ir_samples
 
             X = load_audio(filename=self.fns_ir_seg_list[idx][0],
@@ -562,15 +652,95 @@ class genUnbalSequence(Sequence):
                            seg_length_sec=self.duration,
                            seg_pad_offset_sec=0.0,
                            fs=self.fs,
-                           amp_mode='normal')
+                           amp_mode='normal',
+                           audio_cache=self.ir_audio)
             if len(X) > MAX_IR_LENGTH:
                 X = X[:MAX_IR_LENGTH]
+            return X.reshape(1, -1)
 
-            X = X.reshape(1, -1)
+        Xs = self.__map(load, idx_list)
+        if len(Xs) == 0:
+            return None
+        return np.concatenate(Xs, axis=0)  # (n_batch+n_batch//n_class, fs*k)
 
-            if X_ir_batch is None:
-                X_ir_batch = X
-            else:
-                X_ir_batch = np.concatenate((X_ir_batch, X), axis=0)
 
-        return X_ir_batch
+class PrefetchSequence(Sequence):
+    def __init__(self, sequence, n_prefetch=2):
+        """
+        Wrap a Sequence to prepare the next batches in a background thread.
+
+        Iterating over the wrapper (e.g. 'for X in ds') keeps up to n_prefetch
+        batches ready in a queue while the caller consumes the current one,
+        and hints the OS to read the files of the next batch if the sequence
+        has advise_batch_files() (see genUnbalSequence).
+        Random access (ds[i], e.g. from tf.keras.utils.OrderedEnqueuer, which
+        has its own workers and queue) is passed through unchanged, as well as
+        all the attributes of the wrapped sequence (ds.n_samples, ...).
+
+        Parameters
+        ----------
+        sequence : (Sequence)
+            Sequence to wrap, e.g. genUnbalSequence.
+        n_prefetch : (int), optional
+            Maximum number of batches prepared in advance. The default is 2.
+
+        """
+        self.sequence = sequence
+        self.n_prefetch = n_prefetch
+
+
+    def __getattr__(self, name):
+        # Only called if name was not found in the wrapper itself.
+        if name == 'sequence':
+            raise AttributeError(name)
+        return getattr(self.sequence, name)
+
+
+    def __len__(self):
+        return len(self.sequence)
+
+
+    def __getitem__(self, idx):
+        return self.sequence[idx]
+
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+    def __iter__(self):
+        """ Yield all batches in order, loading the next ones in a thread. """
+        q = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False # The consumer is gone.
+
+        advise = getattr(self.sequence, 'advise_batch_files', None)
+
+        def producer():
+            try:
+                for i in range(len(self.sequence)):
+                    if advise is not None:
+                        advise(i + 1) # Batches are loaded in order here.
+                    if not put((self.sequence[i], None)):
+                        return
+            except Exception as e:
+                put((None, e)) # Re-raised in the consumer thread.
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(self.sequence)):
+                item, err = q.get()
+                if err is not None:
+                    raise err
+                yield item
+        finally:
+            stop.set()